@@ -0,0 +1,49 @@
+import os
+
+import faiss
+import numpy as np
+
+
+def build_index(big_npy: np.ndarray):
+    # recommend parameter in https://github.com/facebookresearch/faiss/wiki/Guidelines-to-choose-an-index
+    emb_ch = big_npy.shape[1]
+    emb_ch_half = emb_ch // 2
+    n_ivf = int(8 * np.sqrt(big_npy.shape[0]))
+    index = faiss.index_factory(emb_ch, f"IVF{n_ivf},PQ{emb_ch_half}x4fsr,RFlat")
+
+    index.train(big_npy)
+    batch_size_add = 8192
+    for i in range(0, big_npy.shape[0], batch_size_add):
+        index.add(big_npy[i : i + batch_size_add])
+    return index
+
+
+def load_index(file_index: str, nprobe: int = 8):
+    # IVF,Flat indexes trained by older versions are rebuilt once as FastScan
+    # and stored next to the original.
+    basename = os.path.splitext(file_index)[0]
+    fastscan_index = f"{basename}.fastscan.index"
+    if os.path.exists(fastscan_index) and os.path.getmtime(
+        fastscan_index
+    ) >= os.path.getmtime(file_index):
+        index = faiss.read_index(fastscan_index)
+    else:
+        index = faiss.read_index(file_index)
+        if isinstance(index, faiss.IndexIVFFlat):
+            print(
+                f"Rebuilding {file_index} as a FastScan index, "
+                "this only happens once and may take a while"
+            )
+            big_npy_path = f"{basename}.big.npy"
+            if os.path.exists(big_npy_path):
+                big_npy = np.load(big_npy_path)
+            else:
+                big_npy = index.reconstruct_n(0, index.ntotal)
+            index = build_index(big_npy.astype(np.float32))
+            faiss.write_index(index, fastscan_index)
+            print(f"Saved {fastscan_index}")
+
+    # extract_index_ivf does not unwrap IndexRefineFlat on faiss 1.7.3
+    faiss.ParameterSpace().set_index_parameter(index, "nprobe", nprobe)
+    index.search(np.zeros((1, index.d), dtype=np.float32), 1)
+    return index
@@ -503,6 +503,7 @@ class SynthesizerTrnMs256NSFSid(nn.Module):
         gin_channels,
         emb_channels,
         sr,
+        build_enc_q=True,
         **kwargs
     ):
         super().__init__()
@@ -550,15 +551,16 @@ class SynthesizerTrnMs256NSFSid(nn.Module):
             sr=sr,
             is_half=kwargs["is_half"],
         )
-        self.enc_q = PosteriorEncoder(
-            spec_channels,
-            inter_channels,
-            hidden_channels,
-            5,
-            1,
-            16,
-            gin_channels=gin_channels,
-        )
+        if build_enc_q:  # only needed for training
+            self.enc_q = PosteriorEncoder(
+                spec_channels,
+                inter_channels,
+                hidden_channels,
+                5,
+                1,
+                16,
+                gin_channels=gin_channels,
+            )
         self.flow = ResidualCouplingBlock(
             inter_channels, hidden_channels, 5, 1, 3, gin_channels=gin_channels
         )
@@ -575,7 +577,8 @@ class SynthesizerTrnMs256NSFSid(nn.Module):
     def remove_weight_norm(self):
         self.dec.remove_weight_norm()
         self.flow.remove_weight_norm()
-        self.enc_q.remove_weight_norm()
+        if hasattr(self, "enc_q"):
+            self.enc_q.remove_weight_norm()
 
     def forward(
         self, phone, phone_lengths, pitch, pitchf, y, y_lengths, ds
@@ -625,6 +628,7 @@ class SynthesizerTrnMs256NSFSidNono(nn.Module):
         gin_channels,
         emb_channels,
         sr=None,
+        build_enc_q=True,
         **kwargs
     ):
         super().__init__()
@@ -669,15 +673,16 @@ class SynthesizerTrnMs256NSFSidNono(nn.Module):
             upsample_kernel_sizes,
             gin_channels=gin_channels,
         )
-        self.enc_q = PosteriorEncoder(
-            spec_channels,
-            inter_channels,
-            hidden_channels,
-            5,
-            1,
-            16,
-            gin_channels=gin_channels,
-        )
+        if build_enc_q:  # only needed for training
+            self.enc_q = PosteriorEncoder(
+                spec_channels,
+                inter_channels,
+                hidden_channels,
+                5,
+                1,
+                16,
+                gin_channels=gin_channels,
+            )
         self.flow = ResidualCouplingBlock(
             inter_channels, hidden_channels, 5, 1, 3, gin_channels=gin_channels
         )
@@ -694,7 +699,8 @@ class SynthesizerTrnMs256NSFSidNono(nn.Module):
     def remove_weight_norm(self):
         self.dec.remove_weight_norm()
         self.flow.remove_weight_norm()
-        self.enc_q.remove_weight_norm()
+        if hasattr(self, "enc_q"):
+            self.enc_q.remove_weight_norm()
 
     def forward(self, phone, phone_lengths, y, y_lengths, ds):  # 这里ds是id，[bs,1]
         g = self.emb_g(ds).unsqueeze(-1)  # [b, 256, 1]##1是t，广播的
@@ -1,5 +1,7 @@
 import os
+import threading
 import traceback
+from contextlib import nullcontext
 from typing import *
 
 import faiss
@@ -13,11 +15,19 @@ from torch import Tensor
 # from faiss.swigfaiss_avx2 import IndexIVFFlat # cause crash on windows' faiss-cpu installed from pip
 from fairseq.models.hubert import HubertModel
 
+from .index import load_index
 from .models import SynthesizerTrnMs256NSFSid
 
 
 class VocalConvertPipeline(object):
-    def __init__(self, tgt_sr: int, device: Union[str, torch.device], is_half: bool):
+    def __init__(
+        self,
+        tgt_sr: int,
+        device: Union[str, torch.device],
+        is_half: bool,
+        embedding_precision: Optional[str] = None,
+        index_nprobe: int = 8,
+    ):
         if isinstance(device, str):
             device = torch.device(device)
         if device.type == "cuda":
@@ -51,6 +61,35 @@ class VocalConvertPipeline(object):
         self.t_max = self.sr * self.x_max  # max time for no query
         self.device = device
         self.is_half = is_half
+        self.index_nprobe = index_nprobe
+        # run the embedder under fp16 autocast even if the rest of the model is fp32
+        self.embedding_half = (
+            embedding_precision or ("fp16" if is_half else "fp32")
+        ) == "fp16"
+        self.input_buffer: Optional[torch.Tensor] = None
+        self.input_copied: Optional[torch.cuda.Event] = None
+        self.input_lock = threading.Lock()
+
+    def to_device(self, audio: np.ndarray) -> torch.Tensor:
+        if self.device.type != "cuda" or audio.ndim != 1:
+            return torch.from_numpy(audio)
+        # reuse a pinned staging buffer across chunks for asynchronous copies.
+        # the pipeline is shared between concurrent requests, so wait for the
+        # pending copy to finish before the buffer is overwritten or replaced.
+        with self.input_lock:
+            if self.input_copied is not None:
+                self.input_copied.synchronize()
+            if (
+                self.input_buffer is None
+                or self.input_buffer.shape[0] < audio.shape[0]
+            ):
+                self.input_buffer = torch.empty(audio.shape[0]).pin_memory()
+            buffer = self.input_buffer[: audio.shape[0]]
+            buffer.copy_(torch.from_numpy(audio))
+            tensor = buffer.to(self.device, non_blocking=True)
+            self.input_copied = torch.cuda.Event()
+            self.input_copied.record(torch.cuda.current_stream(self.device))
+        return tensor
 
     def get_optimal_torch_device(self, index: int = 0) -> torch.device:
         # Get cuda device
@@ -193,24 +232,15 @@ class VocalConvertPipeline(object):
         f0_coarse = np.rint(f0_mel).astype(np.int)
         return f0_coarse, f0bak  # 1-0
 
-    def _convert(
+    def _extract_features(
         self,
         model: HubertModel,
         embedding_output_layer: int,
         net_g: SynthesizerTrnMs256NSFSid,
-        sid: int,
         audio: np.ndarray,
-        pitch: np.ndarray,
-        pitchf: np.ndarray,
-        index: faiss.IndexIVFFlat,
-        big_npy: np.ndarray,
-        index_rate: float,
     ):
-        feats = torch.from_numpy(audio)
-        if self.is_half:
-            feats = feats.half()
-        else:
-            feats = feats.float()
+        # keep the input in fp32, it is cast to the embedder's precision below
+        feats = self.to_device(audio).float()
         if feats.dim() == 2:  # double channels
             feats = feats.mean(-1)
         assert feats.dim() == 1, feats.dim()
@@ -222,6 +252,10 @@ class VocalConvertPipeline(object):
             and torch.cuda.get_device_capability(self.device)[0] >= 5.3
         )
         is_feats_dim_768 = net_g.emb_channels == 768
+        if self.embedding_half and half_support and not self.is_half:
+            autocast = torch.autocast(self.device.type, dtype=torch.float16)
+        else:
+            autocast = nullcontext()
 
         if isinstance(model, tuple):
             feats = model[0](
@@ -233,14 +267,15 @@ class VocalConvertPipeline(object):
                 feats = feats.input_values.to(self.device).half()
             else:
                 feats = feats.input_values.to(self.device)
-            with torch.no_grad():
+            with torch.no_grad(), autocast:
                 if is_feats_dim_768:
                     feats = model[1](feats).last_hidden_state
                 else:
                     feats = model[1](feats).extract_features
         else:
             inputs = {
-                "source": feats.half().to(self.device)
+                # the embedder may run in a different precision than the synthesizer
+                "source": feats.to(self.device, next(model.parameters()).dtype)
                 if half_support
                 else feats.to(self.device),
                 "padding_mask": padding_mask.to(self.device),
@@ -251,13 +286,40 @@ class VocalConvertPipeline(object):
                 model = model.float()
                 inputs["source"] = inputs["source"].float()
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast:
                 logits = model.extract_features(**inputs)
                 if is_feats_dim_768:
                     feats = logits[0]
                 else:
                     feats = model.final_proj(logits[0])
 
+        feats = feats.half() if self.is_half else feats.float()
+        del padding_mask
+        return feats
+
+    def _convert(
+        self,
+        model: HubertModel,
+        embedding_output_layer: int,
+        net_g: SynthesizerTrnMs256NSFSid,
+        sid: int,
+        audio: np.ndarray,
+        pitch: np.ndarray,
+        pitchf: np.ndarray,
+        index: faiss.IndexIVFFlat,
+        big_npy: np.ndarray,
+        index_rate: float,
+        embeddings: Optional[List[torch.Tensor]] = None,
+        chunk: int = 0,
+    ):
+        # embeddings holds the features of each chunk computed by a previous call
+        if embeddings is not None and chunk < len(embeddings):
+            feats = embeddings[chunk].to(self.device)
+        else:
+            feats = self._extract_features(model, embedding_output_layer, net_g, audio)
+            if embeddings is not None:
+                embeddings.append(feats.cpu())
+
         if (
             isinstance(index, type(None)) == False
             and isinstance(big_npy, type(None)) == False
@@ -305,7 +367,7 @@ class VocalConvertPipeline(object):
                     .numpy()
                     .astype(np.int16)
                 )
-        del feats, p_len, padding_mask
+        del feats, p_len
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         return audio1
@@ -323,10 +385,11 @@ class VocalConvertPipeline(object):
         index_rate: float,
         if_f0: bool,
         f0_file: str = None,
+        embeddings: Optional[List[torch.Tensor]] = None,
     ):
         if file_index != "" and os.path.exists(file_index) and index_rate != 0:
             try:
-                index = faiss.read_index(file_index)
+                index = load_index(file_index, self.index_nprobe)
                 # big_npy = np.load(file_big_npy)
                 big_npy = index.reconstruct_n(0, index.ntotal)
             except:
@@ -383,7 +446,7 @@ class VocalConvertPipeline(object):
         s = 0
         t = None
 
-        for t in opt_ts:
+        for chunk, t in enumerate(opt_ts):
             t = t // self.window * self.window
             if if_f0 == 1:
                 audio_opt.append(
@@ -398,6 +461,8 @@ class VocalConvertPipeline(object):
                         index,
                         big_npy,
                         index_rate,
+                        embeddings=embeddings,
+                        chunk=chunk,
                     )[self.t_pad_tgt : -self.t_pad_tgt]
                 )
             else:
@@ -413,6 +478,8 @@ class VocalConvertPipeline(object):
                         index,
                         big_npy,
                         index_rate,
+                        embeddings=embeddings,
+                        chunk=chunk,
                     )[self.t_pad_tgt : -self.t_pad_tgt]
                 )
             s = t
@@ -429,6 +496,8 @@ class VocalConvertPipeline(object):
                     index,
                     big_npy,
                     index_rate,
+                    embeddings=embeddings,
+                    chunk=len(opt_ts),
                 )[self.t_pad_tgt : -self.t_pad_tgt]
             )
         else:
@@ -444,6 +513,8 @@ class VocalConvertPipeline(object):
                     index,
                     big_npy,
                     index_rate,
+                    embeddings=embeddings,
+                    chunk=len(opt_ts),
                 )[self.t_pad_tgt : -self.t_pad_tgt]
             )
         audio_opt = np.concatenate(audio_opt)
@@ -27,6 +27,7 @@ from .config import DatasetMetadata, TrainConfig
 from .data_utils import (DistributedBucketSampler, TextAudioCollate,
                          TextAudioCollateMultiNSFsid, TextAudioLoader,
                          TextAudioLoaderMultiNSFsid)
+from .index import build_index
 from .losses import discriminator_loss, feature_loss, generator_loss, kl_loss
 from .mel_processing import mel_spectrogram_torch, spec_to_mel_torch
 from .models import (MultiPeriodDiscriminator, SynthesizerTrnMs256NSFSid,
@@ -278,21 +279,7 @@ def train_index(
             kmeans.fit(big_npy)
             big_npy = kmeans.cluster_centers_
 
-        # recommend parameter in https://github.com/facebookresearch/faiss/wiki/Guidelines-to-choose-an-index
-        emb_ch = big_npy.shape[1]
-        emb_ch_half = emb_ch // 2
-        n_ivf = int(8 * np.sqrt(big_npy.shape[0]))
-        if big_npy.shape[0] >= 1_000_000:
-            index = faiss.index_factory(
-                emb_ch, f"IVF{n_ivf},PQ{emb_ch_half}x4fsr,RFlat"
-            )
-        else:
-            index = faiss.index_factory(emb_ch, f"IVF{n_ivf},Flat")
-
-        index.train(big_npy)
-        batch_size_add = 8192
-        for i in range(0, big_npy.shape[0], batch_size_add):
-            index.add(big_npy[i : i + batch_size_add])
+        index = build_index(big_npy)
         np.save(
             os.path.join(index_dir, f"{model_name}.{speaker_id}.big.npy"),
             big_npy,
@@ -18,5 +18,37 @@ parser.add_argument(
     default="fp16",
     choices=["fp32", "fp16"],
 )
+parser.add_argument(
+    "--embedding-precision",
+    help="Embedder precision (defaults to --precision, fp16 requires CUDA)",
+    type=str,
+    default=None,
+    choices=["fp32", "fp16"],
+)
+parser.add_argument(
+    "--index-nprobe",
+    help="Number of faiss index clusters to search",
+    type=int,
+    default=8,
+)
+parser.add_argument(
+    "--compile",
+    help="Compile inference models with torch.compile",
+    action="store_true",
+)
+parser.add_argument(
+    "--onnx", help="Run the synthesizer with ONNX Runtime", action="store_true"
+)
+parser.add_argument(
+    "--no-quant",
+    help="Disable int8 dynamic quantization on CPU",
+    action="store_true",
+)
+parser.add_argument(
+    "--num-threads",
+    help="Number of threads used by torch on CPU",
+    type=int,
+    default=None,
+)
 
 opts, _ = parser.parse_known_args()
@@ -50,10 +50,6 @@ def download_models():
         basename = template.format("40")
         url = f"https://huggingface.co/ddPn08/rvc-webui-models/resolve/main/pretrained/v2/{basename}.pth"
         out = os.path.join(MODELS_DIR, "pretrained", "v2", f"{basename}.pth")
-
-        if hash_check(url, out):
-            continue
-
         tasks.append((url, out))
 
     for filename in [
@@ -61,41 +57,33 @@ def download_models():
     ]:
         out = os.path.join(MODELS_DIR, "embeddings", filename)
         url = f"https://huggingface.co/ddPn08/rvc-webui-models/resolve/main/embeddings/{filename}"
-
-        if hash_check(url, out):
-            continue
-
-        tasks.append(
-            (
-                f"https://huggingface.co/ddPn08/rvc-webui-models/resolve/main/embeddings/{filename}",
-                out,
-            )
-        )
+        tasks.append((url, out))
 
     # japanese-hubert-base (Fairseq)
     # from official repo
     # NOTE: change filename?
     hubert_jp_url = f"https://huggingface.co/rinna/japanese-hubert-base/resolve/main/fairseq/model.pt"
     out = os.path.join(MODELS_DIR, "embeddings", "rinna_hubert_base_jp.pt")
-    if not hash_check(hubert_jp_url, out):
-        tasks.append(
-            (
-                hubert_jp_url,
-                out,
+    tasks.append((hubert_jp_url, out))
+
+    with ThreadPoolExecutor(max_workers=min(16, len(tasks))) as pool:
+        # etag requests and sha256 of existing files are independent per file
+        checked = list(pool.map(hash_check, *zip(*tasks)))
+        tasks = [task for task, ok in zip(tasks, checked) if not ok]
+
+        if len(tasks) < 1:
+            return
+
+        # consume the iterator so that download errors are raised
+        list(
+            pool.map(
+                download_file,
+                *zip(
+                    *[(url, out, i, True) for i, (url, out) in enumerate(tasks)]
+                ),
             )
         )
 
-    if len(tasks) < 1:
-        return
-
-    with ThreadPoolExecutor() as pool:
-        pool.map(
-            download_file,
-            *zip(
-                *[(filename, out, i, True) for i, (filename, out) in enumerate(tasks)]
-            ),
-        )
-
 
 def install_ffmpeg():
     if os.path.exists(os.path.join(ROOT_DIR, "bin", "ffmpeg.exe")):
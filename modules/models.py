@@ -1,11 +1,29 @@
+"""Inference model management for the web UI.
+
+The CUDA caching allocator is configured with expandable segments since models
+are swapped frequently during the lifetime of the process. Set
+PYTORCH_CUDA_ALLOC_CONF before launching to override it.
+"""
+
+import functools
+import gc
+import hashlib
+import itertools
 import os
 import re
+import threading
+import traceback
+from collections import OrderedDict
 from typing import *
 
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:256"
+)
+
+import soundfile as sf
 import torch
 from fairseq import checkpoint_utils
 from fairseq.models.hubert.hubert import HubertModel
-from pydub import AudioSegment
 
 from lib.rvc.models import (SynthesizerTrnMs256NSFSid,
                             SynthesizerTrnMs256NSFSidNono)
@@ -17,6 +35,15 @@ from .utils import load_audio
 
 AUDIO_OUT_DIR = opts.output_dir or os.path.join(ROOT_DIR, "outputs")
 
+torch.set_num_threads(opts.num_threads or os.cpu_count() or 1)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    # can only be set before any inter-op parallel work has started
+    pass
+if device.type == "cuda":
+    torch.backends.cudnn.benchmark = True
+
 
 EMBEDDINGS_LIST = {
     "hubert-base-japanese": (
@@ -52,15 +79,10 @@ def update_state_dict(state_dict):
         "emb_channels",
         "sr",
     ]
-    state_dict["params"] = {}
-    n = 0
-    for i, key in enumerate(keys):
-        i = i - n
-        if len(state_dict["config"]) != 19 and key == "emb_channels":
-            # backward compat.
-            n += 1
-            continue
-        state_dict["params"][key] = state_dict["config"][i]
+    if len(state_dict["config"]) != 19:
+        # backward compat.
+        keys.remove("emb_channels")
+    state_dict["params"] = dict(zip(keys, state_dict["config"]))
 
     if not "emb_channels" in state_dict["params"]:
         if state_dict.get("version", "v1") == "v1":
@@ -76,6 +98,7 @@ class VoiceConvertModel:
         update_state_dict(state_dict)
         self.model_name = model_name
         self.state_dict = state_dict
+        self.index_paths = self.scan_index_paths()
         self.tgt_sr = state_dict["params"]["sr"]
         f0 = state_dict.get("f0", 1)
         state_dict["params"]["spk_embed_dim"] = state_dict["weight"][
@@ -86,22 +109,49 @@ class VoiceConvertModel:
 
         if f0 == 1:
             self.net_g = SynthesizerTrnMs256NSFSid(
-                **state_dict["params"], is_half=is_half
+                **state_dict["params"], is_half=is_half, build_enc_q=False
             )
         else:
-            self.net_g = SynthesizerTrnMs256NSFSidNono(**state_dict["params"])
-
-        del self.net_g.enc_q
-
-        self.net_g.load_state_dict(state_dict["weight"], strict=False)
-        self.net_g.eval().to(device)
-
-        if is_half:
-            self.net_g = self.net_g.half()
-        else:
-            self.net_g = self.net_g.float()
+            self.net_g = SynthesizerTrnMs256NSFSidNono(
+                **state_dict["params"], build_enc_q=False
+            )
 
-        self.vc = VocalConvertPipeline(self.tgt_sr, device, is_half)
+        # cast on the host first so that only the final dtype is copied to the device
+        self.net_g.eval().to(torch.float16 if is_half else torch.float32)
+        self.net_g.load_state_dict(
+            {
+                key: value
+                for key, value in state_dict["weight"].items()
+                if not key.startswith("enc_q.")
+            },
+            strict=False,
+        )
+        del state_dict["weight"]
+        self.net_g.to(device, non_blocking=True)
+
+        onnx_path = self.get_cache_path("_onnx", "onnx") if opts.onnx else None
+        if onnx_path is not None:
+            try:
+                if not os.path.exists(onnx_path):
+                    export_onnx(self.net_g, f0, onnx_path)
+                self.net_g = OnnxSynthesizer(onnx_path, self.net_g.emb_channels)
+            except Exception:
+                print("Failed to load ONNX synthesizer, using PyTorch")
+                traceback.print_exc()
+                onnx_path = None
+        if onnx_path is None:
+            if device.type == "cpu" and not opts.no_quant:
+                self.net_g = quantize_dynamic(self.net_g)
+            if opts.compile:
+                torch_compile(self.net_g, "infer", mode="reduce-overhead")
+
+        self.vc = VocalConvertPipeline(
+            self.tgt_sr,
+            device,
+            is_half,
+            embedding_precision=opts.embedding_precision,
+            index_nprobe=opts.index_nprobe,
+        )
         self.n_spk = state_dict["params"]["spk_embed_dim"]
 
     def single(
@@ -162,55 +212,87 @@ class VoiceConvertModel:
         if not faiss_index_file and auto_load_index:
             faiss_index_file = self.get_index_path(sid)
 
-        audio_opt = self.vc(
-            embedder_model,
+        # features only depend on the input audio, the embedder and its projection,
+        # reuse them when re-running with different pitch or index settings
+        embeddings_key = (
+            loaded_embedder_model,
             embedding_output_layer,
-            self.net_g,
-            sid,
-            audio,
-            f0_up_key,
-            f0_method,
-            faiss_index_file,
-            index_rate,
-            f0,
-            f0_file=f0_file,
+            self.state_dict["params"]["emb_channels"],
+            hashlib.blake2b(audio.tobytes(), digest_size=16).digest(),
         )
+        with embeddings_cache_lock:
+            embeddings = embeddings_cache.get(embeddings_key, [])
+
+        with torch.inference_mode():
+            audio_opt = self.vc(
+                embedder_model,
+                embedding_output_layer,
+                self.net_g,
+                sid,
+                audio,
+                f0_up_key,
+                f0_method,
+                faiss_index_file,
+                index_rate,
+                f0,
+                f0_file=f0_file,
+                embeddings=embeddings,
+            )
+
+        with embeddings_cache_lock:
+            embeddings_cache[embeddings_key] = embeddings
+            embeddings_cache.move_to_end(embeddings_key)
+            while len(embeddings_cache) > EMBEDDINGS_CACHE_SIZE:
+                embeddings_cache.popitem(last=False)
 
-        audio = AudioSegment(
-            audio_opt,
-            frame_rate=self.tgt_sr,
-            sample_width=2,
-            channels=1,
-        )
         os.makedirs(output_dir, exist_ok=True)
         input_audio_splitext = os.path.splitext(os.path.basename(input_audio))[0]
         model_splitext = os.path.splitext(self.model_name)[0]
-        index = 0
-        existing_files = os.listdir(output_dir)
-        for existing_file in existing_files:
-            result = re.match(r"\d+", existing_file)
-            if result:
-                prefix_num = int(result.group(0))
-                if index < prefix_num:
-                    index = prefix_num
-        audio.export(
-            os.path.join(
-                output_dir, f"{index+1}-{model_splitext}-{input_audio_splitext}.wav"
-            ),
-            format="wav",
-        )
+        while True:
+            index = get_output_index(output_dir)
+            output_path = os.path.join(
+                output_dir, f"{index}-{model_splitext}-{input_audio_splitext}.wav"
+            )
+            if not os.path.exists(output_path):
+                break
+        sf.write(output_path, audio_opt.reshape(-1), self.tgt_sr, subtype="PCM_16")
         return audio_opt
 
-    def get_index_path(self, speaker_id: int):
+    def get_cache_path(self, cache_dir: str, ext: str):
+        model_path = os.path.join(MODELS_DIR, "checkpoints", self.model_name)
+        if not os.path.isfile(model_path):
+            return None
         basename = os.path.splitext(self.model_name)[0]
-        speaker_index_path = os.path.join(
-            MODELS_DIR,
-            "checkpoints",
-            f"{basename}_index",
-            f"{basename}.{speaker_id}.index",
+        precision = "fp16" if is_half else "fp32"
+        cache_path = os.path.join(
+            MODELS_DIR, cache_dir, f"{basename}.{precision}.{ext}"
         )
-        if os.path.exists(speaker_index_path):
-            return speaker_index_path
+        if (
+            os.path.exists(cache_path)
+            and os.path.getmtime(cache_path) < os.path.getmtime(model_path)
+        ):
+            os.remove(cache_path)
+        return cache_path
+
+    def scan_index_paths(self):
+        basename = os.path.splitext(self.model_name)[0]
+        index_dir = os.path.join(MODELS_DIR, "checkpoints", f"{basename}_index")
+        index_re = re.compile(rf"{re.escape(basename)}\.(\d+)\.index")
+        index_paths: Dict[int, str] = {}
+        try:
+            with os.scandir(index_dir) as entries:
+                for entry in entries:
+                    result = index_re.fullmatch(entry.name)
+                    if result:
+                        index_paths[int(result.group(1))] = entry.path
+        except OSError:
+            pass
+        return index_paths
+
+    def get_index_path(self, speaker_id: int):
+        if speaker_id in self.index_paths:
+            return self.index_paths[speaker_id]
+        basename = os.path.splitext(self.model_name)[0]
         return os.path.join(MODELS_DIR, "checkpoints", f"{basename}.index")
 
 
@@ -219,15 +301,39 @@ vc_model: Optional[VoiceConvertModel] = None
 embedder_model: Optional[HubertModel] = None
 loaded_embedder_model = ""
 
+EMBEDDINGS_CACHE_SIZE = 16
+WEIGHT_CACHE_SIZE = 4
+embeddings_cache: "OrderedDict[tuple, List[torch.Tensor]]" = OrderedDict()
+embeddings_cache_lock = threading.Lock()
+
+MODEL_EXTENSIONS = (".ckpt", ".pth")
+PREFIX_RE = re.compile(rb"\d+")
+output_counters: Dict[str, Iterator[int]] = {}
+output_counters_lock = threading.Lock()
+
+
+def get_output_index(output_dir: str):
+    with output_counters_lock:
+        if output_dir not in output_counters:
+            index = 0
+            with os.scandir(os.fsencode(output_dir)) as entries:
+                for entry in entries:
+                    result = PREFIX_RE.match(entry.name)
+                    if result:
+                        index = max(index, int(result.group(0)))
+            output_counters[output_dir] = itertools.count(index + 1)
+        return next(output_counters[output_dir])
+
 
 def get_models():
     dir = os.path.join(ROOT_DIR, "models", "checkpoints")
     os.makedirs(dir, exist_ok=True)
-    return [
-        file
-        for file in os.listdir(dir)
-        if any([x for x in [".ckpt", ".pth"] if file.endswith(x)])
-    ]
+    with os.scandir(dir) as entries:
+        return [
+            entry.name
+            for entry in entries
+            if entry.is_file() and entry.name.endswith(MODEL_EXTENSIONS)
+        ]
 
 
 def get_embedder(embedder_name):
@@ -236,31 +342,167 @@ def get_embedder(embedder_name):
     return None
 
 
-def load_embedder(emb_file: str, emb_name: str):
-    global embedder_model, loaded_embedder_model
-    emb_file = os.path.join(MODELS_DIR, "embeddings", emb_file)
+class OnnxSynthesizer:
+    def __init__(self, onnx_path: str, emb_channels: int) -> None:
+        import onnxruntime as ort
+
+        so = ort.SessionOptions()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        so.intra_op_num_threads = os.cpu_count() or 1
+        providers = [
+            provider
+            for provider in ["CUDAExecutionProvider", "CPUExecutionProvider"]
+            if provider in ort.get_available_providers()
+        ]
+        self.session = ort.InferenceSession(
+            onnx_path, sess_options=so, providers=providers
+        )
+        self.input_names = [input.name for input in self.session.get_inputs()]
+        self.emb_channels = emb_channels
+
+    def infer(self, *inputs: torch.Tensor, max_len: Optional[int] = None):
+        (audio,) = self.session.run(
+            ["audio"],
+            {
+                name: input.cpu().numpy()
+                for name, input in zip(self.input_names, inputs)
+            },
+        )
+        return (torch.from_numpy(audio[:, :, :max_len]),)
+
+
+class SynthesizerInfer(torch.nn.Module):
+    def __init__(self, net_g: torch.nn.Module) -> None:
+        super().__init__()
+        self.net_g = net_g
+
+    def forward(self, *inputs: torch.Tensor):
+        return self.net_g.infer(*inputs)[0]
+
+
+def export_onnx(net_g: torch.nn.Module, f0: int, onnx_path: str):
+    param = next(net_g.parameters())
+    length = 200
+    phone = torch.rand(1, length, net_g.emb_channels, dtype=param.dtype)
+    phone_lengths = torch.tensor([length]).long()
+    pitch = torch.randint(1, 255, (1, length)).long()
+    pitchf = torch.rand(1, length).float() * 500
+    sid = torch.tensor([0]).long()
+    if f0 == 1:
+        inputs = (phone, phone_lengths, pitch, pitchf, sid)
+        input_names = ["phone", "phone_lengths", "pitch", "pitchf", "sid"]
+    else:
+        inputs = (phone, phone_lengths, sid)
+        input_names = ["phone", "phone_lengths", "sid"]
+    dynamic_axes = {
+        "phone": {1: "T"},
+        "pitch": {1: "T"},
+        "pitchf": {1: "T"},
+        "audio": {2: "L"},
+    }
+    output_names = ["audio"]
+
+    os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+    torch.onnx.export(
+        SynthesizerInfer(net_g),
+        tuple(input.to(param.device) for input in inputs),
+        onnx_path,
+        opset_version=17,
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes={
+            name: axes
+            for name, axes in dynamic_axes.items()
+            if name in input_names + output_names
+        },
+    )
+
+
+def quantize_dynamic(module: torch.nn.Module):
+    # Only Linear layers have dynamic int8 kernels; convolutions are left as is.
+    # Quantize in place, weight normed layers cannot be deep-copied.
+    return torch.quantization.quantize_dynamic(
+        module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def torch_compile(module: torch.nn.Module, method: str, mode: str):
+    if not hasattr(torch, "compile"):
+        print("torch.compile is not available, using eager mode")
+        return
+    from torch._dynamo.exc import TorchDynamoException
+
+    original = getattr(module, method)
+    compiled = torch.compile(original, mode=mode, dynamic=True)
+
+    # graphs are captured on the first call, fall back to eager mode if that fails
+    def run(*args, **kwargs):
+        try:
+            result = compiled(*args, **kwargs)
+        except TorchDynamoException:
+            traceback.print_exc()
+            name = f"{type(module).__name__}.{method}"
+            print(f"Failed to compile {name}, using eager mode")
+            setattr(module, method, original)
+            return original(*args, **kwargs)
+        setattr(module, method, compiled)
+        return result
+
+    setattr(module, method, run)
+
+
+def prepare_embedder(emb_file: str) -> HubertModel:
     models, _, _ = checkpoint_utils.load_model_ensemble_and_task(
-        [emb_file],
+        [os.path.join(MODELS_DIR, "embeddings", emb_file)],
         suffix="",
     )
-    embedder_model = models[0]
-    embedder_model = embedder_model.to(device)
+    model = models[0]
 
-    if is_half:
-        embedder_model = embedder_model.half()
+    if is_half and opts.embedding_precision != "fp32":
+        model = model.half()
     else:
-        embedder_model = embedder_model.float()
-    embedder_model.eval()
+        model = model.float()
+    model = model.to(device, non_blocking=True)
+    model.eval()
 
+    if opts.compile:
+        torch_compile(model, "extract_features", mode="max-autotune")
+
+    return model
+
+
+def load_embedder(emb_file: str, emb_name: str):
+    global embedder_model, loaded_embedder_model
+    embedder_model = prepare_embedder(emb_file)
     loaded_embedder_model = emb_name
 
 
+# checkpoints are kept on the host so that switching back to a recently used
+# model skips the disk read; at most WEIGHT_CACHE_SIZE of them are held at once
+@functools.lru_cache(maxsize=WEIGHT_CACHE_SIZE)
+def load_weight(model_path: str, mtime: float):
+    # not memory-mapped: a mapped checkpoint cannot be overwritten on Windows
+    try:
+        return torch.load(model_path, map_location="cpu", weights_only=True)
+    except Exception:
+        # older torch or checkpoints containing non-tensor objects
+        return torch.load(model_path, map_location="cpu")
+
+
 def get_vc_model(model_name: str):
     model_path = os.path.join(MODELS_DIR, "checkpoints", model_name)
-    weight = torch.load(model_path, map_location="cpu")
+    weight = load_weight(model_path, os.path.getmtime(model_path))
+    # VoiceConvertModel replaces entries of the top level dict, keep the cache intact
+    weight = {**weight}
     return VoiceConvertModel(model_name, weight)
 
 
 def load_model(model_name: str):
     global vc_model
+    # keep the current model until the next one has loaded, a failed load must
+    # not leave the ui without a model
     vc_model = get_vc_model(model_name)
+    # return the previous model's blocks to the allocator right away
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -10,7 +10,6 @@ import torch
 import torch.nn.functional as F
 import torchaudio
 import torchcrepe
-from fairseq import checkpoint_utils
 from fairseq.models.hubert.hubert import HubertModel
 from pydub import AudioSegment
 from torch import Tensor
@@ -20,7 +19,7 @@ from lib.rvc.models import (SynthesizerTrnMs256NSFSid,
 from lib.rvc.pipeline import VocalConvertPipeline
 from modules.cmd_opts import opts
 from modules.models import (EMBEDDINGS_LIST, MODELS_DIR, get_embedder,
-                            get_vc_model, update_state_dict)
+                            get_vc_model, prepare_embedder, update_state_dict)
 from modules.shared import ROOT_DIR, device, is_half
 
 MODELS_DIR = opts.models_dir or os.path.join(ROOT_DIR, "models")
@@ -73,12 +72,20 @@ class VoiceServerModel:
                 state_dict["embedder_output_layer"] = 12
         if self.f0 == 1:
             self.net_g = SynthesizerTrnMs256NSFSid(
-                **state_dict["params"], is_half=is_half
+                **state_dict["params"], is_half=is_half, build_enc_q=False
             )
         else:
-            self.net_g = SynthesizerTrnMs256NSFSidNono(**state_dict["params"])
-        del self.net_g.enc_q
-        self.net_g.load_state_dict(state_dict["weight"], strict=False)
+            self.net_g = SynthesizerTrnMs256NSFSidNono(
+                **state_dict["params"], build_enc_q=False
+            )
+        self.net_g.load_state_dict(
+            {
+                key: value
+                for key, value in state_dict["weight"].items()
+                if not key.startswith("enc_q.")
+            },
+            strict=False,
+        )
         self.net_g.eval().to(device)
         if is_half:
             self.net_g = self.net_g.half()
@@ -88,20 +95,7 @@ class VoiceServerModel:
         emb_name = state_dict.get("embedder_name", "contentvec")
         if emb_name == "hubert_base":
             emb_name = "contentvec"
-        emb_file = os.path.join(MODELS_DIR, "embeddings", EMBEDDINGS_LIST[emb_name][0])
-        models, _, _ = checkpoint_utils.load_model_ensemble_and_task(
-            [emb_file],
-            suffix="",
-        )
-        embedder_model = models[0]
-        embedder_model = embedder_model.to(device)
-
-        if is_half:
-            embedder_model = embedder_model.half()
-        else:
-            embedder_model = embedder_model.float()
-        embedder_model.eval()
-        self.embedder_model = embedder_model
+        self.embedder_model = prepare_embedder(EMBEDDINGS_LIST[emb_name][0])
 
         self.embedder_output_layer = state_dict["embedder_output_layer"]
 
@@ -229,11 +223,8 @@ class VoiceServerModel:
         pitchf: Optional[np.ndarray],
         index_rate: float,
     ):
-        feats = torch.from_numpy(audio)
-        if self.is_half:
-            feats = feats.half()
-        else:
-            feats = feats.float()
+        # keep the input in fp32, it is cast to the embedder's precision below
+        feats = torch.from_numpy(audio).float()
         if feats.dim() == 2:  # double channels
             feats = feats.mean(-1)
         assert feats.dim() == 1, feats.dim()
@@ -263,7 +254,10 @@ class VoiceServerModel:
                     feats = self.embedder_model[1](feats).extract_features
         else:
             inputs = {
-                "source": feats.half().to(self.device)
+                # the embedder may run in a different precision than the synthesizer
+                "source": feats.to(
+                    self.device, next(self.embedder_model.parameters()).dtype
+                )
                 if half_support
                 else feats.to(self.device),
                 "padding_mask": padding_mask.to(self.device),
@@ -281,6 +275,8 @@ class VoiceServerModel:
                 else:
                     feats = self.embedder_model.final_proj(logits[0])
 
+        feats = feats.half() if self.is_half else feats.float()
+
         if (
             isinstance(self.index, type(None)) == False
             and isinstance(self.big_npy, type(None)) == False